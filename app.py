@@ -1,29 +1,62 @@
 import re
-from datetime import datetime, timedelta
+import hashlib
+import itertools
+import threading
+from datetime import date
+from functools import lru_cache
+from typing import NamedTuple
 import io
 
+import numpy as np
 import pandas as pd
 import pdfplumber
+import pypdfium2 as pdfium
 import streamlit as st
 
 st.set_page_config(page_title="Shift Overlap Finder", layout="centered")
 
-# Finds a date anywhere on the line (PDF often has extra text)
-DATE_ANYWHERE_RE = re.compile(
-    r"(Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday),\s+"
-    r"([A-Za-z]+)\s+(\d{1,2}),\s+(\d{4})"
+# Month name or abbreviation -> number (lowercase keys, matched case-insensitively)
+MONTHS = {
+    "january": 1, "february": 2, "march": 3, "april": 4, "may": 5, "june": 6,
+    "july": 7, "august": 8, "september": 9, "october": 10, "november": 11, "december": 12,
+    "jan": 1, "feb": 2, "mar": 3, "apr": 4, "jun": 6, "jul": 7,
+    "aug": 8, "sep": 9, "sept": 9, "oct": 10, "nov": 11, "dec": 12,
+}
+
+# A date anywhere on the line (PDF often has extra text)
+DATE_PATTERN = (
+    r"(?:Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday),[^\S\n]+"
+    r"(?P<month>(?i:" + "|".join(sorted(MONTHS, key=len, reverse=True)) + r"))[^\S\n]+(?P<day>\d{1,2}),[^\S\n]+(?P<year>\d{4})"
 )
 
 # First time-range token on the line = MAIN SHIFT (ignore meal/skills later)
-SHIFT_TOKEN_RE = re.compile(r"\+?\d{1,2}:\d{2}[AP]M-\d{1,2}:\d{2}[AP]M\+?")
+SHIFT_PATTERN = (
+    r"\+?(?P<sh>\d{1,2}):(?P<sm>\d{2})(?P<sap>[AP])M-"
+    r"(?P<eh>\d{1,2}):(?P<em>\d{2})(?P<eap>[AP])M\+?"
+)
+
+# One match per line over the whole document: a date line wins, otherwise
+# everything before the first shift token is the name.
+# No nested quantifiers or backreferences, so each line is scanned at most twice
+# (linear, like RE2); google-re2 matched identically but ~6x slower here.
+SCHEDULE_RE = re.compile(
+    r"^[ \t]*(?:[^\n]*?" + DATE_PATTERN + r"|(?P<name>[^\n]*?)" + SHIFT_PATTERN + r")",
+    re.MULTILINE,
+)
+
+# Obvious non-people headings (matched against the cleaned name)
+BAD_PREFIX_RE = re.compile("|".join(map(re.escape, (
+    "NAME", "SHIFT", "TOTAL", "TIME PERIOD", "QUERY", "PAGE",
+    "FCST", "SCH", "O/U", "SVF"
+))))
 
-def parse_date_from_line(line: str):
-    m = DATE_ANYWHERE_RE.search(line)
-    if not m:
-        return None
-    clean = f"{m.group(1)}, {m.group(2)} {m.group(3)}, {m.group(4)}"
-    return datetime.strptime(clean, "%A, %B %d, %Y").date()
+def to_minutes(hour: str, minute: str, ap: str) -> int:
+    # 12-hour clock -> minutes since midnight, without going through strptime
+    return (int(hour) % 12 + (12 if ap == "P" else 0)) * 60 + int(minute)
 
+# Pure and called for every shift line; the set of distinct raw labels is
+# small, so cache it
+@lru_cache(maxsize=4096)
 def clean_name(raw: str) -> str:
     """
     Converts coverage labels like:
@@ -58,111 +91,216 @@ def clean_name(raw: str) -> str:
 
     return s
 
-@st.cache_data(show_spinner=False)
-def parse_pdf(file_bytes: bytes) -> pd.DataFrame:
-    rows = []
+# PDFium isn't thread-safe (not even across documents) and Streamlit runs each
+# session's script in its own thread, so all PDFium calls go through this lock
+PDFIUM_LOCK = threading.Lock()
+
+def in_visual_order(textpage) -> bool:
+    # PDFium returns text in content-stream order. Trust it only if every text run
+    # starts no higher than the previous run's top edge, i.e. the page reads top to
+    # bottom (a header drawn last or a table drawn column by column jumps back up).
+    tops = []
+    for i in range(textpage.count_rects()):
+        _, bottom, _, top = textpage.get_rect(i)
+        if tops and (bottom + top) / 2 > tops[-1]:
+            return False
+        tops.append(top)
+    return True
+
+def pdfium_text(file_bytes: bytes) -> str | None:
+    # Plain text straight from PDFium: no layout analysis, much faster than pdfplumber.
+    # None if any page's text isn't in visual order (dates would attach to the wrong rows).
+    pages = []
+    with PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_bytes)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                ordered = in_visual_order(textpage)
+                if ordered:
+                    pages.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+                if not ordered:
+                    return None
+        finally:
+            pdf.close()
+    return "\n".join(pages).replace("\r\n", "\n")
+
+def pdfplumber_text(file_bytes: bytes) -> str:
+    # Sequential on purpose: pdfminer is pure Python, so a thread pool over pages
+    # only contends for the GIL (no measurable gain), and PDFium isn't thread-safe
+    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
+        return "\n".join(page.extract_text() or "" for page in pdf.pages)
+
+# Bounded on purpose: uploads are employee schedules on a shared server. Not
+# persist="disk": Streamlit never evicts disk entries (ttl is ignored there and
+# max_entries only trims memory), so every schedule would stay on disk forever.
+# cache_resource: reruns get the same frame back without an unpickle. Keyed by
+# pdf_key (the bytes aren't hashed again); shared between sessions, so callers
+# must not mutate it.
+@st.cache_resource(max_entries=10, ttl="12h", show_spinner=False)
+def parse_pdf(pdf_key: str, _file_bytes: bytes) -> pd.DataFrame:
+    text = pdfium_text(_file_bytes)
+    if text is not None:
+        df, orphans = parse_text(text)
+        if not df.empty and not orphans:
+            return df
+    # PDFium text out of visual order or suspicious: wrong dates are worse than a
+    # slower parse, so use pdfplumber's layout text (rows in reading order)
+    df, _ = parse_text(pdfplumber_text(_file_bytes))
+    return df
+
+def parse_text(text: str) -> tuple[pd.DataFrame, int]:
+    """
+    Returns (shifts, orphans). orphans counts shift tokens that couldn't be
+    attached to a date and a name: seen before the first date, or with nothing
+    before them on the line.
+    """
+    dates, names, start_mins, end_mins = [], [], [], []
     current_date = None
+    orphans = 0
 
-    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-        for page in pdf.pages:
-            text = page.extract_text() or ""
-            for raw in text.splitlines():
-                line = raw.strip()
-                if not line:
-                    continue
-
-                d = parse_date_from_line(line)
-                if d:
-                    current_date = d
-                    continue
-
-                if not current_date:
-                    continue
-
-                mshift = SHIFT_TOKEN_RE.search(line)
-                if not mshift:
-                    continue
-
-                # MAIN shift = first token only
-                shift = mshift.group(0).replace("+", "")
-                start_s, end_s = shift.split("-")
-
-                name_raw = line[:mshift.start()].strip()
-                name = clean_name(name_raw)
-                if not name:
-                    continue
-
-                # skip obvious non-people headings
-                bad_prefix = (
-                    "NAME", "SHIFT", "TOTAL", "TIME PERIOD", "QUERY", "PAGE",
-                    "FCST", "SCH", "O/U", "SVF"
-                )
-                if any(name.startswith(x) for x in bad_prefix):
-                    continue
-
-                start_t = datetime.strptime(start_s, "%I:%M%p").time()
-                end_t   = datetime.strptime(end_s, "%I:%M%p").time()
-
-                start_dt = datetime.combine(current_date, start_t)
-                end_dt   = datetime.combine(current_date, end_t)
-                if end_dt <= start_dt:
-                    end_dt += timedelta(days=1)  # overnight
-
-                rows.append({"date": current_date, "name": name, "start_dt": start_dt, "end_dt": end_dt})
-
-    return pd.DataFrame(rows)
-
-def overlap_days(by_date: dict, names: list[str], require_k: int = 3) -> pd.DataFrame:
+    for m in SCHEDULE_RE.finditer(text):
+        if m.group("year"):
+            current_date = date(int(m.group("year")), MONTHS[m.group("month").lower()], int(m.group("day")))
+            continue
+
+        if not current_date:
+            orphans += 1
+            continue
+
+        name = clean_name(m.group("name"))
+        if not name:
+            orphans += 1
+            continue
+
+        if BAD_PREFIX_RE.match(name):
+            continue
+
+        # MAIN shift = first token only
+        start_min = to_minutes(m.group("sh"), m.group("sm"), m.group("sap"))
+        end_min   = to_minutes(m.group("eh"), m.group("em"), m.group("eap"))
+
+        dates.append(current_date)
+        names.append(name)
+        start_mins.append(start_min)
+        end_mins.append(end_min)
+
+    # minutes since midnight of "date" (end may run past 1440 overnight)
+    start_mins = np.array(start_mins, dtype=np.int32)
+    end_mins = np.array(end_mins, dtype=np.int32)
+    end_mins += (end_mins <= start_mins) * np.int32(24 * 60)  # overnight
+
+    return pd.DataFrame({
+        "date": dates, "name": names,
+        "start_min": start_mins,
+        "end_min": end_mins,
+    }), orphans
+
+# Minutes since midnight -> "9:30 PM" (two days' worth: overnight ends run past 1440)
+TIME_LABELS = np.array([
+    f"{(m // 60) % 12 or 12}:{m % 60:02d} {'AM' if (m // 60) % 24 < 12 else 'PM'}"
+    for m in range(2 * 24 * 60)
+])
+
+# "Not working that date" sentinels for the start/end minute matrices
+NO_START = np.iinfo(np.int32).max
+NO_END = np.iinfo(np.int32).min
+
+class ScheduleIndex(NamedTuple):
+    """
+    Everything the UI derives from the parsed frame, built once per PDF.
+    Rows are dates (sorted, so results come out chronologically), columns are
+    names in names_all order.
+    """
+    date_labels: np.ndarray  # "Mon 03/04/2024" per row, formatted once
+    names_all: list[str]     # sorted
+    name_id: dict            # name -> column
+    start: np.ndarray        # [date, name] int32 earliest start (minutes), NO_START if off
+    end: np.ndarray          # [date, name] int32 latest end (minutes), NO_END if off
+    worked: np.ndarray       # [name] worked dates as a bitmap (np.packbits over dates)
+    n_shifts: int            # for the debug expander
+    example_names: list[str] # first 25 names in PDF order, for the debug expander
+
+@st.cache_resource(max_entries=10, ttl="12h", show_spinner=False)
+def build_indices(pdf_key: str, _df: pd.DataFrame) -> ScheduleIndex:
+    # Keyed by pdf_key (_df itself isn't hashed on every rerun)
+    di, dates = pd.factorize(_df["date"], sort=True)
+    ni, names = pd.factorize(_df["name"], sort=True)
+
+    start = np.full((len(dates), len(names)), NO_START, dtype=np.int32)
+    end = np.full((len(dates), len(names)), NO_END, dtype=np.int32)
+    np.minimum.at(start, (di, ni), _df["start_min"].to_numpy())
+    np.maximum.at(end, (di, ni), _df["end_min"].to_numpy())
+
+    worked = np.packbits(end.T != NO_END, axis=1)
+
+    date_labels = pd.to_datetime(dates).strftime("%a %m/%d/%Y").to_numpy()
+    names_all = names.tolist()
+    name_id = {n: i for i, n in enumerate(names_all)}
+    return ScheduleIndex(
+        date_labels=date_labels, names_all=names_all, name_id=name_id,
+        start=start, end=end, worked=worked,
+        n_shifts=len(_df), example_names=_df["name"].drop_duplicates().head(25).tolist(),
+    )
+
+def overlap_days(indices: ScheduleIndex, names: list[str], require_k: int = 3) -> pd.DataFrame:
     """
     Returns only YES days.
     require_k = 3 means all 3 must overlap.
     require_k = 2 means any 2 of them overlap (optional mode).
     """
-    names = [clean_name(n) for n in names if n]
-    uniq = list(dict.fromkeys(names))
+    # names come from names_all, i.e. already cleaned (clean_name isn't idempotent)
+    uniq = list(dict.fromkeys(n for n in names if n))
     if len(uniq) < 3:
         return pd.DataFrame()
 
-    out = []
-
-    for d in sorted(by_date.keys()):
-        per = by_date[d]  # index = name, cols start_dt/end_dt
-
-        # only consider selected people who exist that date
-        present = [n for n in uniq if n in per.index]
-        if len(present) < require_k:
+    date_labels, name_id = indices.date_labels, indices.name_id
+    start, end, worked = indices.start, indices.end, indices.worked
+    uniq = [n for n in uniq if n in name_id]
+
+    # best overlap so far per date (group -1 = none yet)
+    best_group = np.full(len(date_labels), -1)
+    best_start = np.zeros(len(date_labels), dtype=np.int32)
+    best_end = np.zeros(len(date_labels), dtype=np.int32)
+
+    # if require_k == len(uniq) this is the single group of everyone,
+    # else every combination of size require_k (small list -> brute force is fine)
+    groups = list(itertools.combinations(uniq, require_k))
+    for g, group in enumerate(groups):
+        cols = np.array([name_id[n] for n in group])
+
+        # only dates where everyone in the group works: AND of their bitmaps
+        both = np.bitwise_and.reduce(worked[cols], axis=0)
+        rows = np.flatnonzero(np.unpackbits(both, count=len(date_labels)))
+        if not len(rows):
             continue
 
-        # if require_k == len(uniq), require all selected present
-        # else check combinations of size require_k
-        if require_k == len(uniq):
-            groups = [present]  # all
-        else:
-            # small list -> brute force combos is fine
-            import itertools
-            groups = list(itertools.combinations(present, require_k))
-
-        best = None  # (latest_start, earliest_end, group)
-        for group in groups:
-            sub = per.loc[list(group)]
-            latest_start = sub["start_dt"].max()
-            earliest_end = sub["end_dt"].min()
-            if latest_start < earliest_end:
-                # keep the longest overlap
-                dur = (earliest_end - latest_start).total_seconds()
-                if (best is None) or (dur > (best[1] - best[0]).total_seconds()):
-                    best = (latest_start, earliest_end, group)
-
-        if best:
-            latest_start, earliest_end, group = best
-            out.append({
-                "Day/Date": datetime.combine(d, datetime.min.time()).strftime("%a %m/%d/%Y"),
-                "Common time": f"{latest_start.strftime('%-I:%M %p')} - {earliest_end.strftime('%-I:%M %p')}",
-                "Duration (hrs)": round((earliest_end - latest_start).total_seconds()/3600, 2),
-                "Who overlapped": ", ".join(group)
-            })
-
-    return pd.DataFrame(out)
+        latest_start = start[np.ix_(rows, cols)].max(axis=1)
+        earliest_end = end[np.ix_(rows, cols)].min(axis=1)
+
+        # keep the longest overlap (first group wins ties)
+        better = (latest_start < earliest_end) & (
+            (best_group[rows] < 0)
+            | (earliest_end - latest_start > best_end[rows] - best_start[rows])
+        )
+        hit = rows[better]
+        best_group[hit] = g
+        best_start[hit] = latest_start[better]
+        best_end[hit] = earliest_end[better]
+
+    rows = np.flatnonzero(best_group >= 0)
+    if not len(rows):
+        return pd.DataFrame()
+
+    who = np.array([", ".join(group) for group in groups])
+    return pd.DataFrame({
+        "Day/Date": date_labels[rows],
+        "Common time": np.char.add(np.char.add(TIME_LABELS[best_start[rows]], " - "), TIME_LABELS[best_end[rows]]),
+        "Duration (hrs)": np.round((best_end[rows] - best_start[rows]) / 60, 2),
+        "Who overlapped": who[best_group[rows]],
+    })
 
 st.title("Shift Overlap Finder")
 st.caption("Upload schedule PDF → select 3+ employees → see ONLY the days they overlap. (Ignores meal/skills)")
@@ -171,20 +309,18 @@ pdf = st.file_uploader("Upload schedule PDF", type=["pdf"])
 if not pdf:
     st.stop()
 
+file_bytes = pdf.read()
+pdf_key = hashlib.sha256(file_bytes).hexdigest()
+
 with st.spinner("Reading PDF..."):
-    df = parse_pdf(pdf.read())
+    df = parse_pdf(pdf_key, file_bytes)
 
 if df.empty:
     st.error("No shifts detected. If the PDF is scanned as images, it needs OCR.")
     st.stop()
 
-# Precompute merged daily shift per person: earliest start + latest end
-by_date = {}
-for d, g in df.groupby("date"):
-    per = g.groupby("name").agg(start_dt=("start_dt","min"), end_dt=("end_dt","max"))
-    by_date[d] = per
-
-names_all = sorted(df["name"].drop_duplicates().tolist())
+indices = build_indices(pdf_key, df)
+names_all = indices.names_all
 
 st.subheader("Select employees (minimum 3)")
 c1, c2, c3 = st.columns(3)
@@ -203,7 +339,15 @@ selected = [n1, n2, n3] + extra
 mode = st.radio("Overlap requirement", ["All selected (strict)", "Any 2 of them (backup)"], horizontal=True)
 require_k = len([x for x in selected if x]) if mode == "All selected (strict)" else 2
 
-res = overlap_days(by_date, selected, require_k=require_k)
+# Reruns that keep the same PDF, selection and mode (expander, download button...)
+# reuse the last result instead of recomputing it
+query = (pdf_key, tuple(selected), require_k)
+if st.session_state.get("last_query") == query:
+    res = st.session_state["last_res"]
+else:
+    res = overlap_days(indices, selected, require_k=require_k)
+    st.session_state["last_query"] = query
+    st.session_state["last_res"] = res
 
 st.subheader("Overlap Results (YES days only)")
 if res.empty:
@@ -214,7 +358,7 @@ else:
     st.download_button("Download Results (CSV)", data=csv, file_name="overlap_results.csv", mime="text/csv")
 
 with st.expander("Debug (optional)"):
-    st.caption(f"Shifts read: {len(df)} | Dates: {df['date'].nunique()} | Employees: {df['name'].nunique()}")
+    st.caption(f"Shifts read: {indices.n_shifts} | Dates: {len(indices.date_labels)} | Employees: {len(names_all)}")
     # Show a few names to confirm they look clean (no leading dots)
     st.write("Example employee names detected:")
-    st.write(df["name"].drop_duplicates().head(25).tolist())
+    st.write(indices.example_names)